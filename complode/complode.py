@@ -24,7 +24,7 @@ from lark import Lark, LarkError, Transformer
 # see https://esolangs.org/wiki/Complode
 # requires the lark-parser package from PyPI
 
-def run(code):
+def parse(code):
     parser = Lark(r'''
         prog  : WS* ((cmd | macro) WS+)* (cmd | macro) WS*
         code  : WS+ (cmd WS+)*
@@ -64,78 +64,259 @@ def run(code):
             return [cmd for cmd in args if cmd is not None]
         def prog(self, args):
             return self.macros, [cmd for cmd in args if cmd is not None]
-    def pop(allow_block=False):
-        if len(stack) == 0:
-            return 0
-        if allow_block or isinstance(stack[-1], int):
-            return stack.pop()
-        block = stack.pop()
-        while True:
-            while len(stack) > 0 and stack.pop() != 0:
-                eval_cmds(block)
-            if len(stack) == 0:
-                return 0
-            if isinstance(stack[-1], int):
-                return stack.pop()
-            block = stack.pop()
-    def calculation():
-        a = pop()
-        b = pop()
-        c = pop()
-        e = pop()
-        f = pop()
-        z = pop()
-        if a > 0:
-            if a not in var:
-                var[a] = 0
-            g = var[a]
+    return Parser().transform(parser.parse(code))
+
+# lowered commands, as (op, arg) pairs: PUSH carries an integer or a block,
+# CALL the lowered commands of the macro it refers to, and STORE a variable
+# and the value it is set to by a / worked out ahead of time
+PUSH, CALC, CALL, INP, OUTP, STORE = range(6)
+
+def lower(macros, cmds):
+    # macros can only refer to ones defined before them, so lowering them in
+    # order finds every reference already lowered
+    def walk(cmds):
+        out = []
+        for cmd in cmds:
+            if cmd[0] == 'num':
+                out.append((PUSH, cmd[1]))
+            elif cmd[0] == 'block':
+                out.append((PUSH, walk(cmd[1])))
+            elif cmd[0] == 'ref':
+                out.append((CALL, code[cmd[1]]))
+            else:
+                out.append(({'calc': CALC, 'inp': INP, 'outp': OUTP}[cmd[0]],
+                            None))
+        return out
+    code = {}
+    for name, body in macros.items():
+        code[name] = walk(body)
+    return walk(cmds)
+
+def reach(cmds):
+    # every command list reachable from cmds through calls and blocks, cmds
+    # included, each one after all the lists it reaches
+    seen = {id(cmds)}
+    order = []
+    stack = [(cmds, iter(cmds))]
+    while len(stack) > 0:
+        for op, arg in stack[-1][1]:
+            if isinstance(arg, list) and id(arg) not in seen:
+                seen.add(id(arg))
+                stack.append((arg, iter(arg)))
+                break
         else:
-            g = pop(True)
-        if b > 0:
-            if b not in var:
-                var[b] = 0
-            h = var[b]
+            order.append(stack.pop()[0])
+    return order
+
+def inline(cmds, memo):
+    # splices in macros that come to at most 16 commands once their own
+    # calls are inlined, with memo holding that form of every list called
+    out = []
+    for op, arg in cmds:
+        if op == CALL and len(memo[id(arg)]) <= 16:
+            out.extend(memo[id(arg)])
         else:
-            h = g
-        if c > 0:
-            var[c] = e
-        if b > 0:
-            var[b] = g if isinstance(g, list) else f*g
-        if z > 0:
-            stack.append(h if isinstance(h, list) else e + f + h)
-        if z < 0 and a < 0 and b < 0:
-            x = min(-a, -b)
-            y = max(-a, -b)
-            for n in range(x, y + 1):
-                if n not in var:
-                    var[n] = 0
-            stash.append({n: val for n, val in var.items() if x <= n <= y})
-        if z < 0 and a == 0 and b == 0 and len(stash) > 0:
-            var.update(stash.pop())
-        if z == 0 and a < 0:
-            stack.append(e*f)
-    def eval_cmds(cmds):
-        ip = 0
-        while ip < len(cmds):
-            cmd = cmds[ip]
-            if cmd[0] in ('num', 'block'):
-                stack.append(cmd[1])
-            elif cmd[0] == 'calc':
-                calculation()
-            elif cmd[0] == 'ref':
-                eval_cmds(macros[cmd[1]])
-            elif cmd[0] == 'inp':
+            out.append((op, arg))
+    return out
+
+def fold(cmds, zero):
+    # works out a / ahead of time when its operands were pushed as constants
+    # right before it and the variables it reads are known, leaving only its
+    # stores and pushes; variables are known to be 0 at the very start, and
+    # anything that might run other code or pop unknown values forgets them
+    out = []
+    start = 0
+    vals = {}
+    for op, arg in cmds:
+        if op == CALC and len(out) - start >= 6 and \
+                all(cmd[0] == PUSH and isinstance(cmd[1], int)
+                    for cmd in out[-6:]):
+            a, b, c, e, f, z = [cmd[1] for cmd in reversed(out[-6:])]
+            n = 6
+            if a > 0 and (zero or a in vals):
+                g = vals.get(a, 0)
+            elif a <= 0 and len(out) - start >= 7 and out[-7][0] == PUSH:
+                g = out[-7][1]
+                n = 7
+            else:
+                g = None
+            if b > 0 and z > 0 and (zero or b in vals):
+                h = vals.get(b, 0)
+            elif b > 0 and z > 0:
+                h = None
+            else:
+                h = g
+            if g is not None and h is not None and not (z < 0 and (
+                    a < 0 and b < 0 or a == 0 and b == 0)):
+                del out[-n:]
+                if c > 0:
+                    out.append((STORE, (c, e)))
+                    vals[c] = e
+                if b > 0:
+                    vals[b] = g if isinstance(g, list) else f*g
+                    out.append((STORE, (b, vals[b])))
+                if z > 0:
+                    out.append((PUSH, h if isinstance(h, list) else e + f + h))
+                if z == 0 and a < 0:
+                    out.append((PUSH, e*f))
+                start = min(start, len(out))
+                continue
+        out.append((op, arg))
+        if op != PUSH:
+            start = len(out)
+        if op not in (PUSH, INP):
+            vals = {}
+            zero = False
+    return out
+
+def optimize(cmds):
+    # inlines and folds the top-level commands and every list they reach,
+    # in place, so that calls and blocks pointing at them see the changes;
+    # macros can only call ones defined before them, so none can call itself
+    # and every list comes after the ones it calls
+    memo = {}
+    for body in reach(cmds):
+        memo[id(body)] = inline(body, memo)
+        body[:] = fold(memo[id(body)], body is cmds)
+    return cmds
+
+class Store:
+    # variables, all 0 until set, with small indexes kept in a list; a stash
+    # only marks the undo log, which holds the first value overwritten for
+    # each variable after the latest mark, and a restore rolls back the
+    # entries in the stashed range while keeping the rest for the stash
+    # below it, since those variables outlive the restore
+    def __init__(self):
+        self.dense = [0] * 1024
+        self.sparse = {}
+        self.log = []
+        self.marks = []
+        self.logged = {}
+
+    def __getitem__(self, n):
+        if n < len(self.dense):
+            return self.dense[n]
+        return self.sparse.get(n, 0)
+
+    def __setitem__(self, n, value):
+        if len(self.marks) > 0 and self.logged.get(n) is not self.marks[-1]:
+            self.log.append((n, self[n]))
+            self.logged[n] = self.marks[-1]
+        if n < len(self.dense):
+            self.dense[n] = value
+        else:
+            self.sparse[n] = value
+
+    def stash(self, x, y):
+        self.marks.append((len(self.log), x, y))
+
+    def restore(self):
+        if len(self.marks) == 0:
+            return
+        start, x, y = self.marks.pop()
+        kept = []
+        for n, value in reversed(self.log[start:]):
+            if not x <= n <= y:
+                kept.append((n, value))
+            elif n < len(self.dense):
+                self.dense[n] = value
+            else:
+                self.sparse[n] = value
+        self.log[start:] = reversed(kept)
+
+def calculation(args, stack, var):
+    # runs / once its six operands have been popped
+    a, b, c, e, f, z = args
+    if a > 0:
+        g = var[a]
+    else:
+        g = stack.pop() if len(stack) > 0 else 0
+    if b > 0:
+        h = var[b]
+    else:
+        h = g
+    if c > 0:
+        var[c] = e
+    if b > 0:
+        var[b] = g if isinstance(g, list) else f*g
+    if z > 0:
+        stack.append(h if isinstance(h, list) else e + f + h)
+    if z < 0 and a < 0 and b < 0:
+        var.stash(min(-a, -b), max(-a, -b))
+    if z < 0 and a == 0 and b == 0:
+        var.restore()
+    if z == 0 and a < 0:
+        stack.append(e*f)
+
+def execute(cmds):
+    # frames are [cmds, ip] for running commands, or [need, args, block]
+    # for a / or _O still popping its operands, where popping a block runs
+    # it for as long as the values popped after it are nonzero
+    stack = []
+    var = Store()
+    frames = [[cmds, 0]]
+    while len(frames) > 0:
+        frame = frames[-1]
+        if isinstance(frame[0], list):
+            cmds, ip = frame
+            if ip == len(cmds):
+                frames.pop()
+                continue
+            op, arg = cmds[ip]
+            frame[1] = ip + 1
+            if op == PUSH:
+                stack.append(arg)
+            elif op == CALC and len(stack) >= 6 and \
+                    list not in map(type, stack[-6:]):
+                args = stack[:-7:-1]
+                del stack[-6:]
+                calculation(args, stack, var)
+            elif op == CALC:
+                frames.append([6, [], None])
+            elif op == CALL:
+                if ip + 1 == len(cmds):
+                    frames.pop()
+                frames.append([arg, 0])
+            elif op == INP:
                 chin = sys.stdin.buffer.read(1)
                 stack.append(chin[0] if chin else -1)
-            elif cmd[0] == 'outp':
-                sys.stdout.buffer.write(bytes([pop()]))
+            elif op == OUTP:
+                frames.append([1, [], None])
+            elif op == STORE:
+                var[arg[0]] = arg[1]
+            continue
+        need, args, block = frame
+        while len(args) < need:
+            if block is None:
+                if len(stack) == 0:
+                    args.append(0)
+                    continue
+                elif isinstance(stack[-1], int):
+                    args.append(stack.pop())
+                    continue
+                block = stack.pop()
+            if len(stack) > 0 and stack.pop() != 0:
+                frame[2] = block
+                frames.append([block, 0])
+                break
+            elif len(stack) == 0:
+                args.append(0)
+                block = None
+            elif isinstance(stack[-1], int):
+                args.append(stack.pop())
+                block = None
+            else:
+                block = stack.pop()
+        else:
+            frames.pop()
+            if need == 6:
+                calculation(args, stack, var)
+            else:
+                sys.stdout.buffer.write(bytes([args[0]]))
                 sys.stdout.flush()
-            ip += 1
-    macros, cmds = Parser().transform(parser.parse(code))
-    stack = []
-    var = {}
-    stash = []
-    eval_cmds(cmds)
+
+def run(code):
+    execute(optimize(lower(*parse(code))))
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
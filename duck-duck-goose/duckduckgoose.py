@@ -15,17 +15,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
+import hashlib
 import re
 import sys
 
 # Duck Duck Goose interpreter by LegionMammal978
 # see https://esolangs.org/wiki/Duck_Duck_Goose
 
-def run(code):
-    def d(n, check=True):
-        if n % len(ducks) == 0:
-            raise IndexError('line {}: invalid duck'.format(ip + 1))
-        return (n + g) % len(ducks)
+# linked operations, numbered as their commands
+(EXIT, PRINT, ADD, SUB, MUL, DIV, READ, TAKE, PUT, WHILE, LOOP,
+ SET) = range(12)
+
+def parse(code):
     lines = re.sub('#.*', '', code).lower().split('\n')
     inputs = []
     for i, line in enumerate(lines):
@@ -80,56 +82,218 @@ def run(code):
             labels[line[1]][1] = i
     if any(end is None for start, end in labels.values()):
         raise ValueError('unclosed loop')
-    ducks = [0] * lines[0][0]
+    return lines, labels
+
+def link(lines, labels):
+    # drops input lines, checks duck offsets up front since they do not
+    # depend on the goose, and points loops at the operation to go on with
+    size = lines[0][0]
+    index = {}
+    prog = []
+    for i, line in enumerate(lines):
+        if i == 0 or line[0] == -1:
+            continue
+        index[i] = len(prog)
+        cmd = line[0]
+        if cmd not in (EXIT, LOOP) and line[1] % size == 0 or \
+                ADD <= cmd <= DIV and line[2] % size == 0:
+            raise IndexError('line {}: invalid duck'.format(i + 1))
+        if cmd == EXIT:
+            prog.append((cmd, None, None))
+        elif cmd in (PRINT, READ, TAKE, PUT):
+            prog.append((cmd, line[1] % size, None))
+        elif cmd in (ADD, SUB, MUL, DIV):
+            prog.append((cmd, line[1] % size, line[2] % size))
+        elif cmd in (WHILE, SET):
+            prog.append((cmd, line[1] % size, line[2]))
+        else:
+            prog.append((cmd, line[1], None))
+    for i, (cmd, n, y) in enumerate(prog):
+        if cmd == WHILE:
+            prog[i] = cmd, n, index[labels[y][1]] + 1
+        elif cmd == LOOP:
+            prog[i] = cmd, index[labels[n][0]], None
+    return prog, size
+
+def specialize(prog, size, ip, g):
+    # compiles the straight-line operations from ip, for a goose starting at
+    # g, into a function of the ducks and the held value that returns the
+    # held value, along with the final goose and the operation to go on with
+    body = []
+    while ip < len(prog) and prog[ip][0] not in (EXIT, WHILE, LOOP):
+        cmd, n, y = prog[ip]
+        ip += 1
+        a, b = (n + g) % size, None if y is None else (y + g) % size
+        if cmd == PRINT:
+            body.append('sys.stdout.write(chr(ducks[{}]))'.format(a))
+            continue
+        elif cmd in (ADD, SUB, MUL):
+            body.append('ducks[{}] = ducks[{}] {} ducks[{}]'.format(
+                g, a, '+-*'[cmd - ADD], b))
+        elif cmd == DIV:
+            body.append('nv, yv = ducks[{}], ducks[{}]'.format(a, b))
+            body.append('ducks[{}] = nv//yv if nv*yv > 0 else -(-nv//yv)'
+                        .format(g))
+        elif cmd == READ:
+            body.append('inc = sys.stdin.read(1)')
+            body.append("ducks[{}] = ord(inc) if inc != '' else 0".format(g))
+        elif cmd == TAKE:
+            body.append('tchr = ducks[{}] = ducks[{}]'.format(g, a))
+        elif cmd == PUT:
+            body.append('ducks[0] = tchr')
+            body.append('tchr = 0')
+        elif cmd == SET:
+            body.append('ducks[{}] = {}'.format(g, y))
+        g = a
+    src = 'def block(ducks, tchr):\n{}    return tchr\n'.format(
+        ''.join('    {}\n'.format(line) for line in body))
+    env = {'sys': sys}
+    exec(compile(src, '<duck duck goose block>', 'exec'), env)
+    return env['block'], g, ip
+
+def execute(prog, size):
+    # blocks are specialized for each goose position they are entered with,
+    # once they have been entered often enough
+    leaders = {0}
+    for i, (cmd, n, y) in enumerate(prog):
+        if cmd == WHILE:
+            leaders.update((i + 1, y))
+    blocks = {}
+    heat = {}
+    ducks = [0] * size
     tchr = 0
     g = 0
-    ip = 1
-    while ip < len(lines):
-        line = lines[ip]
-        cmd = line[0]
-        if len(line) > 1:
-            n = line[1]
-        if len(line) > 2:
-            y = line[2]
-        if cmd == 0:
-            sys.exit()
-        elif cmd == 1:
-            sys.stdout.write(chr(ducks[d(n)]))
-        elif cmd == 2:
-            ducks[g] = ducks[d(n)] + ducks[d(y)]
-            g = d(n, False)
-        elif cmd == 3:
-            ducks[g] = ducks[d(n)] - ducks[d(y)]
-            g = d(n, False)
-        elif cmd == 4:
-            ducks[g] = ducks[d(n)] * ducks[d(y)]
-            g = d(n, False)
-        elif cmd == 5:
-            nv, yv = ducks[d(n)], ducks[d(y)]
+    ip = 0
+    while ip < len(prog):
+        if ip in leaders:
+            block = blocks.get((ip, g))
+            if block is None and prog[ip][0] not in (EXIT, WHILE, LOOP):
+                heat[ip] = heat.get(ip, 0) + 1
+                if heat[ip] >= 8:
+                    if len(blocks) >= 1 << 12:
+                        blocks.clear()
+                    block = blocks[ip, g] = specialize(prog, size, ip, g)
+            if block is not None:
+                block, g, ip = block[0], block[1], block[2]
+                tchr = block(ducks, tchr)
+                if ip == len(prog):
+                    break
+        cmd, n, y = prog[ip]
+        if cmd == EXIT:
+            return
+        elif cmd == PRINT:
+            sys.stdout.write(chr(ducks[(n + g) % size]))
+        elif cmd == ADD:
+            ducks[g] = ducks[(n + g) % size] + ducks[(y + g) % size]
+            g = (n + g) % size
+        elif cmd == SUB:
+            ducks[g] = ducks[(n + g) % size] - ducks[(y + g) % size]
+            g = (n + g) % size
+        elif cmd == MUL:
+            ducks[g] = ducks[(n + g) % size] * ducks[(y + g) % size]
+            g = (n + g) % size
+        elif cmd == DIV:
+            nv, yv = ducks[(n + g) % size], ducks[(y + g) % size]
             ducks[g] = nv//yv if nv*yv > 0 else -(-nv//yv)
-            g = d(n, False)
-        elif cmd == 6:
+            g = (n + g) % size
+        elif cmd == READ:
             inc = sys.stdin.read(1)
             ducks[g] = ord(inc) if inc != '' else 0
-            g = d(n, False)
-        elif cmd == 7:
-            ducks[g] = ducks[d(n)]
-            tchr = ducks[d(n)]
-            g = d(n, False)
-        elif cmd == 8:
+            g = (n + g) % size
+        elif cmd == TAKE:
+            ducks[g] = ducks[(n + g) % size]
+            tchr = ducks[(n + g) % size]
+            g = (n + g) % size
+        elif cmd == PUT:
             ducks[0] = tchr
             tchr = 0
-            g = d(n, False)
-        elif cmd == 9 and ducks[d(n)] == 0:
-            ip = labels[y][1]
-        elif cmd == 10:
-            ip = labels[n][0] - 1
-        elif cmd == 11:
+            g = (n + g) % size
+        elif cmd == WHILE and ducks[(n + g) % size] == 0:
+            ip = y
+            continue
+        elif cmd == LOOP:
+            ip = n
+            continue
+        elif cmd == SET:
             ducks[g] = y
-            g = d(n, False)
+            g = (n + g) % size
         ip += 1
     raise ValueError('missing end command')
 
+def transpile(prog, size, limit=1 << 12):
+    # turns a program whose loops nest into a single Python function, with
+    # output collected and written in chunks, or returns None if they do not,
+    # if it has no loops, or if it has more than limit commands, since then
+    # compiling costs more than running it through execute
+    if len(prog) > limit or WHILE not in (cmd for cmd, n, y in prog):
+        return None
+    lines = []
+    stack = []
+    for i, (cmd, n, y) in enumerate(prog):
+        pad = '    '*(len(stack) + 2)
+        a, b = '(g + {}) % {}'.format(n, size), '(g + {}) % {}'.format(y, size)
+        if cmd == EXIT:
+            lines.append(pad + 'return')
+            continue
+        elif cmd == PRINT:
+            lines.append(pad + 'out.append(chr(ducks[{}]))'.format(a))
+            lines.append(pad + 'if len(out) >= 4096:')
+            lines.append(pad + "    sys.stdout.write(''.join(out))")
+            lines.append(pad + '    out.clear()')
+            continue
+        elif cmd == WHILE:
+            lines.append(pad + 'while ducks[{}]:'.format(a))
+            stack.append(y - 1)
+            continue
+        elif cmd == LOOP:
+            if not stack or stack.pop() != i:
+                return None
+            if lines[-1].endswith(':'):
+                lines.append(pad + 'pass')
+            continue
+        elif cmd in (ADD, SUB, MUL):
+            lines.append(pad + 'ducks[g] = ducks[{}] {} ducks[{}]'.format(
+                a, '+-*'[cmd - ADD], b))
+        elif cmd == DIV:
+            lines.append(pad + 'nv, yv = ducks[{}], ducks[{}]'.format(a, b))
+            lines.append(pad + 'ducks[g] = nv//yv if nv*yv > 0 '
+                         'else -(-nv//yv)')
+        elif cmd == READ:
+            lines.append(pad + "sys.stdout.write(''.join(out))")
+            lines.append(pad + 'out.clear()')
+            lines.append(pad + 'inc = sys.stdin.read(1)')
+            lines.append(pad + "ducks[g] = ord(inc) if inc != '' else 0")
+        elif cmd == TAKE:
+            lines.append(pad + 'tchr = ducks[g] = ducks[{}]'.format(a))
+        elif cmd == PUT:
+            lines.append(pad + 'ducks[0] = tchr')
+            lines.append(pad + 'tchr = 0')
+        elif cmd == SET:
+            lines.append(pad + 'ducks[g] = {}'.format(y))
+        lines.append(pad + 'g = {}'.format(a))
+    src = 'def program():\n    ducks = [0] * {}\n    tchr = 0\n    g = 0\n' \
+        '    out = []\n    try:\n{}        pass\n    finally:\n' \
+        "        sys.stdout.write(''.join(out))\n" \
+        "    raise ValueError('missing end command')\n".format(
+        size, ''.join(line + '\n' for line in lines))
+    env = {'sys': sys}
+    try:
+        exec(compile(src, '<duck duck goose>', 'exec'), env)
+    except (RecursionError, SyntaxError):
+        return None
+    return env['program']
+
+# programs, validated and compiled, by the SHA-256 of their source
+compiled = {}
+
+def run(code):
+    key = hashlib.sha256(code.encode()).digest()
+    if key not in compiled:
+        prog, size = link(*parse(code))
+        compiled[key] = transpile(prog, size) or \
+            functools.partial(execute, prog, size)
+    compiled[key]()
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('usage: {} file'.format(sys.argv[0]), file=sys.stderr)
@@ -15,88 +15,406 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import io
 import re
 import sys
 
 # Noodle Soup interpreter by LegionMammal978
 # see https://esolangs.org/wiki/Noodle_Soup
 
-def run(code):
-    code = re.sub('[^01]', '', code)
+# decoded operations; only jumps are cached per bit offset, since finding
+# their targets means scanning the program
+INC, DEC, RIGHT, LEFT, IN, OUT, JUMP, HALT = range(8)
+# lowered operations for regions whose jumps nest as loops and ifs
+ADD, MOVE, LOOP, IF, MUL = range(8, 13)
+
+def load(f):
+    # streams the source, keeping only the bits packed 8 to a byte, along
+    # with an empty cache of the jumps decoded at each bit offset
+    bits = bytearray()
+    size = 0
+    pending = ''
+    while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            break
+        chunk = re.sub('[^01]', '', chunk)
+        size += len(chunk)
+        pending += chunk
+        whole = len(pending) - len(pending) % 8
+        if whole:
+            bits += int(pending[:whole], 2).to_bytes(whole // 8, 'big')
+            pending = pending[whole:]
+    if pending:
+        bits.append(int(pending.ljust(8, '0'), 2))
+    bits += bytes(2)
+    return bits, size, {}
+
+def scan(prog, word, ip, forward):
+    # the offset after the nearest site of the 8-bit word past ip in the
+    # given direction, or None, unpacking windows that double in size
+    bits, size = prog[:2]
+    target = format(word, '08b')
+    width = 1 << 8
+    lo = hi = ip
+    while forward and hi < size - 7 or not forward and lo > 0:
+        if forward:
+            lo, hi = hi + (hi == ip), min(hi + width, size - 7)
+        else:
+            lo, hi = max(lo - width, 0), lo
+        chunk = bits[lo >> 3:(hi + 7 >> 3) + 1]
+        text = format(int.from_bytes(chunk, 'big'),
+                      '0{}b'.format(len(chunk)*8))
+        base = lo >> 3 << 3
+        if forward:
+            site = text.find(target, lo - base, hi + 7 - base)
+        else:
+            site = text.rfind(target, lo - base, hi + 7 - base)
+        if site >= 0:
+            return base + site + 8
+        width *= 2
+    return None
+
+def kind(word):
+    # the operation an 8-bit word starts with and the bits it takes up
+    if word >> 6 == 0b10:
+        return INC, 2
+    elif word >> 6 == 0b01:
+        return DEC, 2
+    elif word >> 5 == 0b111:
+        return RIGHT, 3
+    elif word >> 5 == 0b000:
+        return LEFT, 3
+    elif word >> 4 == 0b1100:
+        return IN, 4
+    elif word >> 4 == 0b0011:
+        return OUT, 4
+    return JUMP, 8
+
+kinds = [kind(word) for word in range(256)]
+
+def decode(prog, ip):
+    # the operation at ip and the offset after it, or for jumps the offsets
+    # reached on a zero and a nonzero cell, with None halting
+    bits, size = prog[:2]
+    byte = bits[ip >> 3] << 8 | bits[(ip >> 3) + 1]
+    word = byte >> (8 - (ip & 7)) & 0xFF
+    op, width = kinds[word]
+    if ip + width > size:
+        return HALT, None, None
+    elif op != JUMP:
+        return op, ip + width, None
+    forward = word >> 4 == 0b1101
+    word = (word & 0xF) << 4 | (0b1011 if forward else 0b0100)
+    after = scan(prog, word, ip, True)
+    before = scan(prog, word, ip, False)
+    if forward:
+        return JUMP, after, before
+    return JUMP, before, after
+
+def fetch(prog, ip):
+    # decodes the operation at ip, keeping jumps in the program's cache
+    op = prog[2].get(ip)
+    if op is None:
+        op = decode(prog, ip)
+        if op[0] == JUMP:
+            prog[2][ip] = op
+    return op
+
+def lower(prog, start, end=None, close=False, limit=1 << 16):
+    # parses the operations from start until end into nested loops and ifs,
+    # returning them with the offset execution continues at (None if it
+    # halts), or None if some jump does not fit this structure or more than
+    # limit operations are needed; with close, stops as soon as everything so
+    # far becomes one loop back to start
+    ir = []
+    heads = {}
+    ip = start
+    for _ in range(limit):
+        if ip == end:
+            return ir, ip
+        elif end is not None and ip > end:
+            return None
+        op, nxt, alt = fetch(prog, ip)
+        if op == HALT:
+            if close:
+                return None
+            ir.append((HALT,))
+            return ir, None
+        elif op != JUMP:
+            heads[ip] = len(ir)
+            ir.append({INC: (ADD, 1), DEC: (ADD, 255), RIGHT: (MOVE, 1, 0, 1),
+                       LEFT: (MOVE, -1, -1, 0), IN: (IN,), OUT: (OUT,)}[op])
+            ip = nxt
+            continue
+        back = [t for t in (nxt, alt) if t is not None and t <= ip]
+        if len(back) == 0 and nxt == alt:
+            if nxt is None:
+                if close:
+                    return None
+                ir.append((HALT,))
+                return ir, None
+            ip = nxt
+        elif len(back) == 0 and None in (nxt, alt):
+            heads[ip] = len(ir)
+            ir.append((IF, nxt is not None, [(HALT,)]))
+            ip = nxt if nxt is not None else alt
+        elif len(back) == 0:
+            body = lower(prog, min(nxt, alt), max(nxt, alt), limit=limit)
+            if body is None:
+                return None
+            heads[ip] = len(ir)
+            ir.append((IF, alt < nxt, body[0]))
+            ip = max(nxt, alt)
+        elif back[0] in heads and (len(back) == 1 or nxt == alt):
+            # a jump back to an earlier operation ends a do-while loop
+            k = heads[back[0]]
+            cond = None if nxt == alt else alt == back[0]
+            ir[k:] = [(LOOP, cond, ir[k:])]
+            for head in [head for head, i in heads.items() if i > k]:
+                del heads[head]
+            ip = nxt if alt == back[0] else alt
+            if cond is None or ip is None:
+                ir.append((HALT,))
+                return ir, None
+            elif close and k == 0:
+                return ir, ip
+        else:
+            return None
+    return None
+
+def fold(ir):
+    # merges runs of adds and moves and turns loops that only add to cells
+    # around a counter stepped by an odd amount into single multiplications
+    out = []
+    for node in ir:
+        if node[0] == ADD and out and out[-1][0] == ADD:
+            out[-1] = ADD, (out[-1][1] + node[1]) & 255
+        elif node[0] == MOVE and out and out[-1][0] == MOVE:
+            n, lo, hi = out[-1][1:]
+            out[-1] = MOVE, n + node[1], min(lo, n + node[2]), \
+                max(hi, n + node[3])
+        elif node[0] in (LOOP, IF):
+            out.append((node[0], node[1], fold(node[2])))
+        else:
+            out.append(node)
+        if out[-1] == (ADD, 0) or \
+                out[-1][0] == MOVE and out[-1][1:3] == (0, 0):
+            out.pop()
+    for i, node in enumerate(out):
+        if node[0] != LOOP or node[1] is not True or \
+                any(op[0] not in (ADD, MOVE) for op in node[2]):
+            continue
+        cells = {}
+        offset = lo = hi = 0
+        for op in node[2]:
+            if op[0] == ADD:
+                cells[offset] = cells.get(offset, 0) + op[1]
+            else:
+                lo = min(lo, offset + op[2])
+                hi = max(hi, offset + op[3])
+                offset += op[1]
+        step = cells.pop(0, 0) & 255
+        if offset == 0 and step % 2 == 1:
+            out[i] = MUL, step, tuple((offset, n & 255)
+                for offset, n in cells.items() if n & 255), lo, hi
+    return out
+
+def perform(ir, data, dp):
+    # runs lowered operations on the tape, returning the new data pointer,
+    # or None if the program halted
+    for node in ir:
+        op = node[0]
+        if op == ADD:
+            data[dp] = (data[dp] + node[1]) & 255
+        elif op == MOVE or op == MUL:
+            if dp + node[-2] < 0:
+                raise IndexError('moved past leftmost cell')
+            if dp + node[-1] >= len(data):
+                data.extend(bytes(dp + node[-1] + 1 - len(data)))
+            if op == MOVE:
+                dp += node[1]
+                continue
+            n = -data[dp]*pow(node[1], -1, 256) % 256
+            for offset, factor in node[2]:
+                data[dp + offset] = (data[dp + offset] + factor*n) & 255
+            data[dp] = 0
+        elif op == IN:
+            chin = sys.stdin.buffer.read(1)
+            data[dp] = chin[0] if chin else 255
+        elif op == OUT:
+            sys.stdout.buffer.write(bytes([data[dp]]))
+            sys.stdout.flush()
+        elif op == LOOP:
+            while True:
+                dp = perform(node[2], data, dp)
+                if dp is None:
+                    return None
+                if node[1] is not None and (data[dp] != 0) != node[1]:
+                    break
+        elif op == IF:
+            if (data[dp] != 0) == node[1]:
+                dp = perform(node[2], data, dp)
+                if dp is None:
+                    return None
+        elif op == HALT:
+            return None
+    return dp
+
+def emit(ir, lines, indent):
+    # appends Python statements running lowered operations on data at dp
+    pad = '    '*indent
+    if not ir:
+        lines.append(pad + 'pass')
+    for node in ir:
+        op = node[0]
+        if op == ADD:
+            lines.append(pad + 'data[dp] = (data[dp] + {}) & 255'
+                         .format(node[1]))
+        elif op == MOVE or op == MUL:
+            if node[-2] < 0:
+                lines.append(pad + 'if dp < {}:'.format(-node[-2]))
+                lines.append(pad + '    raise IndexError('
+                             "'moved past leftmost cell')")
+            if node[-1] > 0:
+                lines.append(pad + 'if dp + {} >= len(data):'
+                             .format(node[-1]))
+                lines.append(pad + '    data.extend(bytes(dp + {} + 1 - '
+                             'len(data)))'.format(node[-1]))
+            if op == MOVE:
+                lines.append(pad + 'dp += {}'.format(node[1]))
+                continue
+            if node[2]:
+                lines.append(pad + 'n = data[dp]*{}'
+                             .format(-pow(node[1], -1, 256) % 256))
+            for offset, factor in node[2]:
+                lines.append(pad + 'data[dp + {0}] = (data[dp + {0}] + '
+                             '{1}*n) & 255'.format(offset, factor))
+            lines.append(pad + 'data[dp] = 0')
+        elif op == IN:
+            lines.append(pad + 'data[dp] = read()')
+        elif op == OUT:
+            lines.append(pad + 'write(data[dp])')
+        elif op == LOOP:
+            lines.append(pad + 'while True:')
+            emit(node[2], lines, indent + 1)
+            if node[1] is not None:
+                lines.append(pad + '    if {}data[dp]:'
+                             .format('not ' if node[1] else ''))
+                lines.append(pad + '        break')
+        elif op == IF:
+            lines.append(pad + 'if {}data[dp]:'
+                         .format('' if node[1] else 'not '))
+            emit(node[2], lines, indent + 1)
+        elif op == HALT:
+            lines.append(pad + 'return')
+
+def transpile(prog, limit=1 << 12):
+    # compiles a program of at most limit operations whose jumps all nest as
+    # loops and ifs into a Python function of the tape, or returns None if
+    # some jump does not or the program is larger; compile() costs more
+    # than the stepper saves on big programs, which mostly run straight
+    # through
+    bits, size = prog[:2]
+    key = size, hashlib.sha256(bits).digest()
+    if key not in transpiled:
+        transpiled[key] = None
+        try:
+            ir = lower(prog, 0, limit=limit)
+            if ir is not None:
+                lines = ['def program(data, read, write):', '    dp = 0']
+                emit(fold(ir[0]), lines, 1)
+                if len(lines) <= 4*limit:
+                    env = {}
+                    exec(compile('\n'.join(lines), '<noodle soup>', 'exec'),
+                         env)
+                    transpiled[key] = env['program']
+        except (RecursionError, SyntaxError):
+            pass
+    return transpiled[key]
+
+transpiled = {}
+
+def read():
+    chin = sys.stdin.buffer.read(1)
+    return chin[0] if chin else 255
+
+def write(value):
+    sys.stdout.buffer.write(bytes([value]))
+    sys.stdout.flush()
+
+def execute(prog):
+    program = transpile(prog)
+    if program is not None:
+        program(bytearray(1), read, write)
+        return
+    bits, size, ops = prog
+    regions = {}
     ip = 0
     dp = 0
-    data = [0]
+    data = bytearray(1)
     while True:
-        if ip + 1 >= len(code):
+        byte = bits[ip >> 3] << 8 | bits[(ip >> 3) + 1]
+        op, nxt = kinds[byte >> (8 - (ip & 7)) & 0xFF]
+        nxt += ip
+        if nxt > size:
             return
-        elif code[ip : ip+2] == '10':
-            data[dp] += 1
-            if data[dp] == 256:
-                data[dp] = 0
-            ip += 2
-        elif code[ip : ip+2] == '01':
-            data[dp] -= 1
-            if data[dp] == -1:
-                data[dp] = 255
-            ip += 2
-        elif ip + 2 >= len(code):
-            return
-        elif code[ip : ip+3] == '111':
+        elif op == INC:
+            data[dp] = (data[dp] + 1) & 255
+        elif op == DEC:
+            data[dp] = (data[dp] - 1) & 255
+        elif op == RIGHT:
             dp += 1
             if dp == len(data):
                 data.append(0)
-            ip += 3
-        elif code[ip : ip+3] == '000':
+        elif op == LEFT:
             dp -= 1
             if dp == -1:
                 raise IndexError('moved past leftmost cell')
-            ip += 3
-        elif ip + 3 >= len(code):
-            return
-        elif code[ip : ip+4] == '1100':
+        elif op == IN:
             chin = sys.stdin.buffer.read(1)
             if chin:
                 data[dp] = chin[0]
             else:
                 data[dp] = 255
-            ip += 4
-        elif code[ip : ip+4] == '0011':
+        elif op == OUT:
             sys.stdout.buffer.write(bytes([data[dp]]))
             sys.stdout.flush()
-            ip += 4
-        elif ip + 7 >= len(code):
+        else:
+            op = ops.get(ip)
+            if op is None:
+                op = ops[ip] = decode(prog, ip)
+            nxt = op[2] if data[dp] != 0 else op[1]
+            # a jump back to a loop that nests cleanly runs the whole loop
+            # in lowered form and continues after it
+            if nxt is not None and nxt <= ip:
+                region = regions.get(nxt)
+                if region is None:
+                    region = lower(prog, nxt, close=True) or ()
+                    if region:
+                        region = fold(region[0]), region[1]
+                    regions[nxt] = region
+                if region:
+                    dp = perform(region[0], data, dp)
+                    if dp is None:
+                        return
+                    nxt = region[1]
+        if nxt is None:
             return
-        elif code[ip : ip+4] == '1101':
-            target = code[ip+4:ip+8] + '1011'
-            inc = 1 if data[dp] == 0 else -1
-            ip += inc
-            while 0 <= ip <= len(code) - 8:
-                if code[ip : ip+8] == target:
-                    break
-                ip += inc
-            if ip < 0 or ip + 7 >= len(code):
-                return
-            ip += 8
-        elif code[ip : ip+4] == '0010':
-            target = code[ip+4:ip+8] + '0100'
-            inc = -1 if data[dp] == 0 else 1
-            ip += inc
-            while 0 <= ip <= len(code) - 8:
-                if code[ip : ip+8] == target:
-                    break
-                ip += inc
-            if ip < 0 or ip + 7 >= len(code):
-                return
-            ip += 8
+        ip = nxt
+
+def run(code):
+    execute(load(io.StringIO(code)))
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('usage: {} file'.format(sys.argv[0]), file=sys.stderr)
         sys.exit(2)
     with open(sys.argv[1], 'r') as f:
-        code = f.read()
+        prog = load(f)
     try:
-        run(code)
+        execute(prog)
     except Exception as e:
         print('error: {}'.format(e), file=sys.stderr)
         sys.exit(1)
@@ -22,7 +22,109 @@ import sys
 # Pizza Delivery interpreter by LegionMammal978
 # see https://esolangs.org/wiki/Pizza_Delivery
 
-def run(code):
+# instructions, decoded once with literals parsed and comments dropped
+(LIT, MOVE, MAP, IN, OUT, HALT, TOGGLE, WHILE, IF, END, AT, GOTO,
+ FAIL, LINEAR, STEP) = range(15)
+
+def isprime(l):
+    if l % 2 == 0 or l < 2:
+        return l == 2
+    return not any(l % i == 0 for i in range(3, int(l**.5) + 1, 2))
+
+# the square is kept flat, with cell (x, y) at 16*x + y; cell operations
+# are translation tables, and moves are tables of where each position ends
+# up (-1 if off of the square)
+increment = bytes((l + 1) % 256 for l in range(256))
+decrement = bytes((l - 1) % 256 for l in range(256))
+double = bytes(2*l % 256 for l in range(256))
+prime = bytes(isprime(l) for l in range(256))
+even = bytes(l % 2 for l in range(256))
+rot13 = bytes(ord(codecs.encode(chr(l), 'rot_13')) for l in range(256))
+
+def move(cmd):
+    dx = (cmd in 'dec') - (cmd in 'aqz')
+    dy = (cmd in 'szc') - (cmd in 'wqe')
+    return tuple(p + 16*dx + dy
+                 if 0 <= p//16 + dx < 16 and 0 <= p%16 + dy < 16 else -1
+                 for p in range(256)), 16*dx + dy
+
+moves = {cmd: move(cmd) for cmd in 'wasdqezc'}
+
+def single(cmd):
+    # the instruction for a one-character command, or None if it does nothing
+    if cmd in '0123456789ABCDEF':
+        return LIT, int(cmd, 16), None
+    elif cmd in 'wasdqezc':
+        return (MOVE,) + moves[cmd]
+    elif cmd in '+-*':
+        return MAP, {'+': increment, '-': decrement, '*': double}[cmd], None
+    elif cmd in '?`.{':
+        return {'?': IN, '`': OUT, '.': HALT, '{': TOGGLE}[cmd], None, None
+    elif cmd in '/\\' or cmd.isspace():
+        return None
+    return FAIL, 'unrecognized statement {}'.format(cmd), None
+
+def execute(l):
+    # the instruction @ runs for a cell value, with AT standing for the
+    # : statement decoded at that particular @
+    cmd = chr(l)
+    if cmd in '[(]#@':
+        return FAIL, 'invalid @ output {}'.format(cmd), None
+    elif cmd == ':':
+        return AT, None, None
+    return single(cmd)
+
+executed = [execute(l) for l in range(256)]
+
+def colon(code, ip):
+    # the instruction for a : statement whose letter is at ip
+    if ip == len(code):
+        return FAIL, 'incomplete : statement', None
+    elif code[ip] in 'PER':
+        return MAP, {'P': prime, 'E': even, 'R': rot13}[code[ip]], None
+    return FAIL, 'unrecognized statement :{}'.format(code[ip]), None
+
+def scan(code, ip):
+    # decodes the command at ip, returning its instruction (with source
+    # offsets in place of targets) and the offset of the next command
+    cmd = code[ip]
+    if cmd == '#':
+        end = code.find('#', ip + 1)
+        return None, len(code) if end == -1 else end + 1
+    elif cmd in '0123456789ABCDEF':
+        end = ip
+        while end < len(code) and code[end] in '0123456789ABCDEF':
+            end += 1
+        if end == len(code):
+            return (HALT, None, None), end
+        return (LIT, int(code[ip:end], 16) % 256, None), end
+    elif cmd == ':':
+        return colon(code, ip + 1), min(ip + 2, len(code))
+    elif cmd == '@':
+        return (AT, colon(code, ip + 1), min(ip + 2, len(code))), ip + 1
+    elif cmd in '[(]':
+        return ({'[': WHILE, '(': IF, ']': END}[cmd], ip, None), ip + 1
+    return single(cmd), ip + 1
+
+def chain(code, prog, entries, ip):
+    # decodes the commands from ip onward until they reach ones already
+    # decoded, returning the index of the instruction for ip
+    start = ip
+    while ip not in entries:
+        entries[ip] = len(prog)
+        if ip == len(code):
+            prog.append((HALT, None, None))
+            break
+        inst, ip = scan(code, ip)
+        if inst is not None:
+            prog.append(inst)
+    else:
+        if ip != start:
+            prog.append((GOTO, entries[ip], None))
+    return entries[start]
+
+def parse(code):
+    # blocks are matched on the raw source, as [ and ] may follow a : or @
     blocks = {}
     blstack = []
     ip = 0
@@ -43,86 +145,212 @@ def run(code):
         ip += 1
     if len(blstack) > 0:
         raise ValueError('missing ] statements')
-    sq = [[0]*16 for _ in range(16)]
-    lx, ly = 0, 0
-    ip = 0
-    iswhile, iscomm = True, False
-    while ip < len(code):
-        cmd = code[ip]
-        if iscomm:
-            if cmd == '#':
-                iscomm = False
-            ip += 1
+    # a jump lands after blocks[ip], which might not begin an instruction of
+    # the main sequence (say, within a literal), so it gets its own chain
+    prog = []
+    entries = {}
+    chain(code, prog, entries, 0)
+    for i, (op, a, b) in enumerate(prog):
+        if op in (WHILE, IF, END) and a not in blocks:
+            prog[i] = FAIL, 'unrecognized statement {}'.format(code[a]), None
+        elif op in (WHILE, IF, END):
+            prog[i] = op, chain(code, prog, entries, blocks[a] + 1), None
+        elif op == AT:
+            prog[i] = op, a, chain(code, prog, entries, b)
+    for i, (op, a, b) in enumerate(prog):
+        if op == WHILE:
+            prog[i] = linear(prog, i) or prog[i]
+    bounds(prog)
+    return prog
+
+def linear(prog, h):
+    # a [ loop at h whose body only moves and adds, ending where it began
+    # with the header cell stepped by an odd amount, runs -x/step times for
+    # header value x; it becomes a LINEAR instruction holding the multiplier
+    # for x, what each other cell gains per iteration, and which starting
+    # positions keep the body on the square
+    cells = {}
+    offset = 0
+    safe = list(range(256))
+    i = h + 1
+    while prog[i][0] == MOVE or \
+            prog[i][0] == MAP and prog[i][1] in (increment, decrement):
+        op, a, b = prog[i]
+        if op == MOVE:
+            offset += b
+            safe = [p if p < 0 else a[p] for p in safe]
+        else:
+            cells[offset] = cells.get(offset, 0) + \
+                (1 if a is increment else -1)
+        i += 1
+    step = cells.pop(0, 0) % 256
+    if prog[i][0] != END or prog[i][1] != h or offset != 0 or step % 2 == 0:
+        return None
+    cells = tuple((q, n % 256) for q, n in cells.items() if n % 256)
+    safe = bytes(p >= 0 for p in safe)
+    return LINEAR, prog[h][1], (-pow(step, -1, 256) % 256, cells, safe)
+
+def bounds(prog):
+    # finds a box of positions the pointer can be in before each reachable
+    # instruction, then turns each move that cannot leave the square from
+    # anywhere in its box into a STEP by a fixed offset without a check
+    boxes = {0: (0, 0, 0, 0)}
+    work = [0]
+    while work:
+        i = work.pop()
+        x0, x1, y0, y1 = boxes[i]
+        op, a, b = prog[i]
+        if op == MOVE:
+            dx = (b + 8)//16
+            dy = b - 16*dx
+            x0, x1, y0, y1 = x0 + dx, x1 + dx, y0 + dy, y1 + dy
+        elif op == AT:
+            x0, x1, y0, y1 = x0 - 1, x1 + 1, y0 - 1, y1 + 1
+        box = max(x0, 0), min(x1, 15), max(y0, 0), min(y1, 15)
+        if box[0] > box[1] or box[2] > box[3] or op in (HALT, FAIL):
             continue
-        if cmd in '0123456789ABCDEF':
-            num = ''
-            while ip < len(code):
-                cmd = code[ip]
-                if cmd not in '0123456789ABCDEF':
-                    break
-                num += cmd
+        elif op in (WHILE, IF, END, LINEAR):
+            nexts = a, i + 1
+        elif op == GOTO:
+            nexts = a,
+        elif op == AT:
+            nexts = i + 1, b
+        else:
+            nexts = i + 1,
+        for j in nexts:
+            old = boxes.get(j, box)
+            new = (min(old[0], box[0]), max(old[1], box[1]),
+                   min(old[2], box[2]), max(old[3], box[3]))
+            if boxes.get(j) != new:
+                boxes[j] = new
+                work.append(j)
+    for i, (op, a, b) in enumerate(prog):
+        if op == MOVE and i in boxes:
+            x0, x1, y0, y1 = boxes[i]
+            if all(a[16*x + y] >= 0 for x in (x0, x1) for y in (y0, y1)):
+                prog[i] = STEP, b, None
+
+def trace(prog, h):
+    # compiles the loop headed by the [ or ( at h into a function running it
+    # from the header, which returns the position and the instruction to go
+    # on with; the body must be straight-line, and an @ that turns into
+    # anything but a cell operation leaves the function at that @
+    body = []
+    env = {'sys': sys, 'executed': executed, 'MAP': MAP, 'LIT': LIT}
+    i = h + 1
+    while prog[i][0] != END:
+        op, a, b = prog[i]
+        name = 't{}'.format(i)
+        if op == LIT:
+            body.append('sq[p] = {}'.format(a))
+        elif op == MAP:
+            env[name] = a
+            body.append('sq[p] = {}[sq[p]]'.format(name))
+        elif op == STEP:
+            body.append('p += {}'.format(a))
+        elif op == MOVE:
+            env[name] = a
+            body.append('p = {}[p]'.format(name))
+            body.append('if p < 0:')
+            body.append("    raise IndexError('pointer ran off of square')")
+        elif op == IN:
+            body.append('chin = sys.stdin.buffer.read(1)')
+            body.append('sq[p] = chin[0] if chin else 255')
+        elif op == OUT:
+            body.append('sys.stdout.buffer.write(bytes([sq[p]]))')
+            body.append('sys.stdout.flush()')
+        elif op == AT:
+            body.append('inst = executed[sq[p]]')
+            body.append('if inst is None:')
+            body.append('    pass')
+            body.append('elif inst[0] == MAP:')
+            body.append('    sq[p] = inst[1][sq[p]]')
+            body.append('elif inst[0] == LIT:')
+            body.append('    sq[p] = inst[1]')
+            body.append('else:')
+            body.append('    return p, {}'.format(i))
+        else:
+            return False
+        i += 1
+    if prog[i][1] != h:
+        return False
+    op, a, b = prog[h]
+    src = 'def loop(sq, p, iswhile):\n    while sq[p] {} 0:\n{}' \
+        '        if not iswhile:\n            return p, {}\n' \
+        '    return p, {}\n'.format('==' if op == IF else '!=',
+        ''.join('        {}\n'.format(line) for line in body), i + 1, a)
+    exec(compile(src, '<pizza delivery loop>', 'exec'), env)
+    return env['loop']
+
+def run(code):
+    prog = parse(code)
+    loops = {}
+    heat = {}
+    sq = bytearray(256)
+    p = 0
+    ip = 0
+    iswhile = True
+    while True:
+        op, a, b = prog[ip]
+        if op == LINEAR:
+            mult, cells, safe = b
+            if iswhile and sq[p] and safe[p]:
+                n = sq[p]*mult % 256
+                for q, m in cells:
+                    sq[p + q] = (sq[p + q] + m*n) % 256
+                sq[p] = 0
+                ip = a
+                continue
+            op = WHILE
+        elif op == AT:
+            inst = executed[sq[p]]
+            if inst is None:
                 ip += 1
+                continue
+            elif inst[0] == AT:
+                ip = b - 1
+                op, a, b = a
             else:
-                return
-            sq[lx][ly] = int(num, 16) % 256
-        while cmd == '@':
-            cmd = chr(sq[lx][ly])
-            if cmd in '[(]#':
-                raise ValueError('invalid @ output {}'.format(cmd))
-        if cmd in '0123456789ABCDEF':
-            sq[lx][ly] = int(cmd, 16)
-        elif cmd in 'wasdqezc':
-            lx += (cmd in 'dec') - (cmd in 'aqz')
-            ly += (cmd in 'szc') - (cmd in 'wqe')
-            if not (0 <= lx < 16 and 0 <= ly < 16):
+                op, a, b = inst
+        if op == MAP:
+            sq[p] = a[sq[p]]
+        elif op == STEP:
+            p += a
+        elif op == MOVE:
+            p = a[p]
+            if p < 0:
                 raise IndexError('pointer ran off of square')
-        elif cmd == '?':
+        elif op == LIT:
+            sq[p] = a
+        elif op == IN:
             chin = sys.stdin.buffer.read(1)
-            sq[lx][ly] = chin[0] if chin else 255
-        elif cmd == '`':
-            sys.stdout.buffer.write(bytes([sq[lx][ly]]))
+            sq[p] = chin[0] if chin else 255
+        elif op == OUT:
+            sys.stdout.buffer.write(bytes([sq[p]]))
             sys.stdout.flush()
-        elif cmd == '+':
-            sq[lx][ly] = (sq[lx][ly]+1) % 256
-        elif cmd == '-':
-            sq[lx][ly] = (sq[lx][ly]-1) % 256
-        elif cmd == '*':
-            sq[lx][ly] = 2*sq[lx][ly] % 256
-        elif cmd == ':':
-            ip += 1
-            if ip == len(code):
-                raise ValueError('incomplete : statement')
-            cmd = code[ip]
-            if cmd == 'P':
-                l = sq[lx][ly]
-                if l % 2 == 0 or l < 2:
-                    sq[lx][ly] = int(l == 2)
-                else:
-                    c = any(l % i == 0 for i in range(3, int(l**.5) + 1, 2))
-                    sq[lx][ly] = int(not c)
-            elif cmd == 'E':
-                sq[lx][ly] %= 2
-            elif cmd == 'R':
-                sq[lx][ly] = ord(codecs.encode(chr(sq[lx][ly]), 'rot_13'))
-            else:
-                raise ValueError('unrecognized statement :{}'.format(cmd))
-        elif cmd == '.':
+        elif op == HALT:
             return
-        elif cmd in '/\\' or cmd.isspace():
-            pass
-        elif cmd == '[':
-            if sq[lx][ly] == 0:
-                ip = blocks[ip]
-        elif cmd == '(':
-            if sq[lx][ly] > 0:
-                ip = blocks[ip]
-        elif cmd == ']':
+        elif op == WHILE or op == IF:
+            # loops are compiled once their header has run often enough
+            loop = loops.get(ip)
+            if loop:
+                p, ip = loop(sq, p, iswhile)
+                continue
+            elif loop is None:
+                heat[ip] = heat.get(ip, 0) + 1
+                if heat[ip] == 16:
+                    loops[ip] = trace(prog, ip)
+            if sq[p] == 0 if op == WHILE else sq[p] > 0:
+                ip = a - 1
+        elif op == END:
             if iswhile:
-                ip = blocks[ip]
-        elif cmd == '{':
+                ip = a - 1
+        elif op == TOGGLE:
             iswhile = not iswhile
-        else:
-            raise ValueError('unrecognized statement {}'.format(cmd))
+        elif op == GOTO:
+            ip = a - 1
+        elif op == FAIL:
+            raise ValueError(a)
         ip += 1
 
 if __name__ == '__main__':
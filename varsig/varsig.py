@@ -15,20 +15,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bisect
 import re
 import sys
 
 # Varsig interpreter by LegionMammal978
 # see https://esolangs.org/wiki/Varsig
 
-def run(code):
-    def parsenum(s):
-        if s.isalpha():
-            i = ord(s) - 65
-            varread[i] = True
-            return var[i]
-        else:
-            return int(s)
+# decoded commands, numbered in the order of their names in syms
+(SIG, TERM, MEASURE, TRIP, RESET, PRY, CRAM, EXIT, LESS, MORE, GOOD, EVIL,
+ CLEAN, DIRTY, GROW, SHRINK, PURGE, BURN, SHOVE, YANK, CLONE, PUSH, PULL,
+ FLIP) = range(24)
+opcodes = {sym: op for op, sym in enumerate('{}"^.()#<>=?_&+-\\|!~:][%')}
+
+def parse(code):
     syms = {
         'SIG': '{', 'TERM': '}', 'MEASURE': '"', 'TRIP': '^', 'RESET': '.',
         'PRY': '(', 'CRAM': ')', 'EXIT': '#', 'LESS': '<', 'MORE': '>',
@@ -49,94 +49,149 @@ def run(code):
     if sum(len(cmd) for cmd in cmds) != len(code):
         inval = ''.join(re.split(cmd_regex, code))
         raise ValueError('unrecognized characters {}'.format(inval))
+    return cmds
+
+def decode(cmds):
+    # each command becomes (op, arg, isvar, target): arg is a literal, a
+    # variable index if isvar, or None without an operand, and target is
+    # the last command skipped when a SIG or a chain of conditionals skips
+    # ahead
+    prog = []
+    stack = []
+    for ip, cmd in enumerate(cmds):
+        op = opcodes[cmd[0]]
+        if len(cmd) == 1:
+            prog.append([op, None, False, None])
+        elif cmd[1:].isalpha():
+            prog.append([op, ord(cmd[1:]) - 65, True, None])
+        else:
+            prog.append([op, int(cmd[1:]), False, None])
+        if op == SIG:
+            stack.append(ip)
+        elif op == TERM:
+            if len(stack) == 0:
+                raise ValueError('too many TERM commands')
+            prog[stack.pop()][3] = ip
+    if len(stack) > 0:
+        raise ValueError('too few TERM commands')
+    target = None
+    for ip in reversed(range(len(prog))):
+        if LESS <= prog[ip][0] <= DIRTY:
+            prog[ip][3] = target
+        else:
+            target = ip
+    return [tuple(rec) for rec in prog]
+
+def execute(prog):
+    # values are only reduced by a MEASURE when they are next read: each
+    # stack entry and tape half carries the epoch it was last reduced in,
+    # and floors[i] is the smallest exponent measured since marks[i]
+    def settle(x, e):
+        return x & ((1 << floors[bisect.bisect_left(marks, e)]) - 1)
+    def top():
+        if stamps[-1] != epoch:
+            stack[-1] = settle(stack[-1], stamps[-1])
+            stamps[-1] = epoch
+        return stack[-1]
+    def pop():
+        x, e = stack.pop(), stamps.pop()
+        return x if e == epoch else settle(x, e)
+    def cell():
+        c = tape[tp]
+        if c[2 + tf] != epoch:
+            c[tf] = settle(c[tf], c[2 + tf])
+            c[2 + tf] = epoch
+        return c[tf]
     ctrip = set()
     ntrip = set()
-    sigs = {}
     stack = []
-    tape = [[0, 0]]
+    stamps = []
+    tape = [[0, 0, 0, 0]]
     ip = 0
     tp = 0
     tf = False
     var = [0]*26
     varread = [False]*26
     measure = 256
-    while ip < len(cmds):
-        if cmds[ip][0] == '{':
-            stack.append(ip)
-        elif cmds[ip][0] == '}':
-            if len(stack) == 0:
-                raise ValueError('too many TERM commands')
-            sigs[stack.pop()] = ip
-        ip += 1
-    if len(stack) > 0:
-        raise ValueError('too few TERM commands')
-    ip = 0
+    epoch = 0
+    marks = [0]
+    floors = [8]
     while True:
-        cmd = cmds[ip]
-        num = parsenum(cmd[1:]) if len(cmd) > 1 else None
-        if cmd[0] == '{' and num not in ctrip:
-            ip = sigs[ip]
-        elif cmd[0] == '"':
+        op, num, isvar, target = prog[ip]
+        if isvar:
+            varread[num] = True
+            num = var[num]
+        if op == SIG and num not in ctrip:
+            ip = target
+        elif op == MEASURE:
             measure = 2**num
-            for i in range(len(stack)):
-                stack[i] %= measure
-            for i in range(len(tape)):
-                tape[i][0] %= measure
-                tape[i][1] %= measure
-        elif cmd[0] == '^':
+            epoch += 1
+            while floors and floors[-1] >= num:
+                marks.pop()
+                floors.pop()
+            marks.append(epoch)
+            floors.append(num)
+        elif op == TRIP:
             ntrip.add(num)
-        elif cmd[0] == '.':
+        elif op == RESET:
             ntrip.remove(num)
-        elif cmd[0] == '(':
+        elif op == PRY:
             chin = sys.stdin.buffer.read(1)
             if chin:
                 stack.append(chin[0] % measure)
-        elif cmd[0] == ')' and len(stack) > 0:
-            sys.stdout.buffer.write(bytes([stack.pop() % 256]))
+                stamps.append(epoch)
+        elif op == CRAM and len(stack) > 0:
+            sys.stdout.buffer.write(bytes([pop() % 256]))
             sys.stdout.flush()
-        elif cmd[0] == '#':
+        elif op == EXIT:
             break
-        elif (cmd[0] in '<>&' and len(stack) == 0 or
-              cmd[0] == '_' and len(stack) > 0 or
-              cmd[0] == '<' and tape[tp][tf] >= stack[-1] or
-              cmd[0] == '>' and tape[tp][tf] <= stack[-1] or
-              cmd[0] == '=' and len(stack) > 0 and tape[tp][tf] != stack[-1] or
-              cmd[0] == '?' and len(stack) > 0 and tape[tp][tf] == stack[-1]):
-            while cmds[ip][0] in '<>=?_&':
-                ip += 1
-        elif cmd[0] == '+' and (num is not None or len(stack) > 0):
-            tape[tp][tf] += stack.pop() if num is None else num
-            tape[tp][tf] %= measure
-        elif cmd[0] == '-' and (num is not None or len(stack) > 0):
-            tape[tp][tf] -= stack.pop() if num is None else num
-            tape[tp][tf] %= measure
-        elif cmd[0] == '\\':
+        elif (op in (LESS, MORE, DIRTY) and len(stack) == 0 or
+              op == CLEAN and len(stack) > 0 or
+              op == LESS and cell() >= top() or
+              op == MORE and cell() <= top() or
+              op == GOOD and len(stack) > 0 and cell() != top() or
+              op == EVIL and len(stack) > 0 and cell() == top()):
+            ip = target
+        elif op == GROW and (num is not None or len(stack) > 0):
+            tape[tp][tf] = (cell() + (pop() if num is None else num)) % measure
+        elif op == SHRINK and (num is not None or len(stack) > 0):
+            tape[tp][tf] = (cell() - (pop() if num is None else num)) % measure
+        elif op == PURGE:
             tape[tp][tf] = 0
-        elif cmd[0] == '|' and len(stack) > 0:
+            tape[tp][2 + tf] = epoch
+        elif op == BURN and len(stack) > 0:
             stack.pop()
-        elif cmd[0] == '!':
-            stack.append(tape[tp][tf] if num is None else num % measure)
-        elif cmd[0] == '~' and len(stack) > 0:
+            stamps.pop()
+        elif op == SHOVE:
+            if num is None:
+                stack.append(tape[tp][tf])
+                stamps.append(tape[tp][2 + tf])
+            else:
+                stack.append(num % measure)
+                stamps.append(epoch)
+        elif op == YANK and len(stack) > 0:
             tape[tp][tf] = stack.pop()
-        elif cmd[0] == ':' and len(stack) > 0:
+            tape[tp][2 + tf] = stamps.pop()
+        elif op == CLONE and len(stack) > 0:
             stack.append(stack[-1])
-        elif cmd[0] == ('[' if tf else ']'):
+            stamps.append(stamps[-1])
+        elif op == (PULL if tf else PUSH):
             if num is None:
                 num = 1
             if tp < num:
                 for _ in range(num - tp):
-                    tape.insert(0, [0, 0])
+                    tape.insert(0, [0, 0, 0, 0])
                 tp = 0
             else:
                 tp -= num
-        elif cmd[0] == (']' if tf else '['):
+        elif op == (PUSH if tf else PULL):
             tp += 1 if num is None else num
             while tp >= len(tape):
-                tape.append([0, 0])
-        elif cmd[0] == '%':
+                tape.append([0, 0, 0, 0])
+        elif op == FLIP:
             tf = not tf
         ip += 1
-        if ip == len(cmds):
+        if ip == len(prog):
             ip = 0
             ctrip = ntrip
             ntrip = set()
@@ -144,6 +199,9 @@ def run(code):
                 var[i] += varread[i]
                 varread[i] = False
 
+def run(code):
+    execute(decode(parse(code)))
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('usage: {} file'.format(sys.argv[0]), file=sys.stderr)
@@ -15,33 +15,32 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bisect
 import re
 import sys
 
 # VD3 interpreter by LegionMammal978
 # see https://esolangs.org/wiki/VD3
 # note: -1 disables VD3 2.0 functionality
+# note: run_batch requires the numpy package from PyPI
 
 apat = '([A-E]|PC|IN|OUT|-?[0-9]+)'
 cpat = fr'(\.{3})?([A-E]|PC|IN|OUT)<-{apat}\^{apat}\^{apat}'
 
-def run(code, v1=False):
-    def value(arg):
-        if isinstance(arg, int):
-            return arg
-        elif arg in 'ABCDE':
-            return vardict[arg]
-        elif arg == 'PC':
-            return ip
-        elif arg == 'IN':
-            chin = sys.stdin.buffer.read(1)
-            return chin[0] if chin else -1
-    cmds = []
+# decoded operations: a register or PC set to the sum of up to three
+# registers and a constant, or a generic operation involving IN or OUT
+SET0, SET1, SET2, SET3, JMP0, JMP1, JMP2, JMP3, GEN = range(9)
+PC, OUT = 5, 6
+
+def parse(code, v1=False):
+    # runs of a repeated command are kept as (cmd, line, count) entries
+    runs = []
     repeat = False
     for i, line in enumerate(code.split('\n')):
         if line == '':
             if repeat:
-                cmds.append(cmds[-1])
+                cmd, line, count = runs[-1]
+                runs[-1] = cmd, line, count + 1
             continue
         match = re.fullmatch(cpat, line)
         if match is None:
@@ -55,27 +54,451 @@ def run(code, v1=False):
         if 'OUT' in match[2:]:
             raise ValueError('line {}: cannot read from OUT'.format(i + 1))
         args = tuple(arg if arg.isalpha() else int(arg) for arg in match[1:])
-        cmds.append(args)
-    ip = 0
-    vardict = {'A': 0, 'B': 0, 'C': 0, 'D': 0, 'E': 0}
+        runs.append((args, i + 1, 1))
+    starts = []
+    n = 0
+    for cmd, line, count in runs:
+        starts.append(n)
+        n += count
+    return runs, starts, n, repeat
+
+def decode(cmd, line, ip=None):
+    # PC reads are folded into the constant when the position is known
+    if cmd[0] in ('PC', 'OUT'):
+        dst = PC if cmd[0] == 'PC' else OUT
+    else:
+        dst = 'ABCDE'.index(cmd[0])
+    k = pcs = nin = 0
+    regs = ()
+    for arg in cmd[1:]:
+        if isinstance(arg, int):
+            k += arg
+        elif arg == 'PC':
+            pcs += 1
+        elif arg == 'IN':
+            nin += 1
+        else:
+            regs += 'ABCDE'.index(arg),
+    if ip is not None:
+        k += pcs*ip
+        pcs = 0
+    if dst == OUT or pcs > 0 or nin > 0:
+        return GEN, dst, regs, pcs, nin, k, line
+    op = (JMP0 if dst == PC else SET0) + len(regs)
+    return (op, dst, *regs, *(0,)*(3 - len(regs)), k, line)
+
+def read():
+    chin = sys.stdin.buffer.read(1)
+    return chin[0] if chin else -1
+
+def write(total, line, count=1):
+    if total < 0 or total > 255:
+        raise ValueError('line {}: invalid character'.format(line))
+    sys.stdout.buffer.write(bytes([total])*count)
+    sys.stdout.flush()
+
+def operands(op):
+    # the destination, registers, PC reads, IN reads, constant and line
+    op, d, a, b, c, k, line = op
+    if op == GEN:
+        return d, a, b, c, k, line
+    return d, (a, b, c)[:(op - SET0) % 4], 0, 0, k, line
+
+def step(op, r, ip, read, write):
+    # executes a single decoded operation, returning the next line
+    op, d, a, b, c, k, line = op
+    if op == SET0:
+        r[d] = k
+    elif op == SET1:
+        r[d] = r[a] + k
+    elif op == SET2:
+        r[d] = r[a] + r[b] + k
+    elif op == SET3:
+        r[d] = r[a] + r[b] + r[c] + k
+    elif op == JMP0:
+        return k
+    elif op == JMP1:
+        return r[a] + k
+    elif op == JMP2:
+        return r[a] + r[b] + k
+    elif op == JMP3:
+        return r[a] + r[b] + r[c] + k
+    else:
+        total = k + b*ip + sum(r[x] for x in a)
+        for _ in range(c):
+            total += read()
+        if d < 5:
+            r[d] = total
+        elif d == PC:
+            return total
+        else:
+            write(total, line)
+    return ip + 1
+
+def superblock(prog, ip, read, write):
+    # follows static control flow from ip until a data-dependent PC write,
+    # a line already in the block, or a line outside the program, and
+    # compiles the whole path into a single function returning the next
+    # line; the rest of a run of repeated commands is folded where possible
+    runs, starts, n, repeat = prog
+    names = 'ABCDE'
+    body = []
+    seen = set()
+    written = set()
+    while 0 <= ip < n and ip not in seen and len(body) < 256:
+        seen.add(ip)
+        i = bisect.bisect(starts, ip) - 1
+        cmd, line, count = runs[i]
+        op = decode(cmd, line, ip)
+        if op[0] == JMP0:
+            ip = op[5]
+            continue
+        d, regs, pcs, nin, k, line = operands(op)
+        terms = [names[x] for x in regs] + ['read()']*nin
+        total = ' + '.join(terms + [str(k)] if k or not terms else terms)
+        if d == PC:
+            body.append('ip = {}'.format(total))
+            break
+        j = starts[i] + count - ip
+        pcs = cmd[1:].count('PC')
+        looped = ' + '.join(terms + [str(k), '{}*q'.format(pcs)])
+        if d == OUT and j > 1 and (pcs > 0 or nin > 0):
+            body.append('for q in range({}): write({}, {})'.format(
+                j, looped, line))
+        elif d == OUT:
+            body.append('write({}, {}, {})'.format(total, line, j))
+        elif j == 1:
+            body.append('{} = {}'.format(names[d], total))
+        elif nin == 0 and d not in regs:
+            terms.append(str(k + pcs*(j - 1)))
+            body.append('{} = {}'.format(names[d], ' + '.join(terms)))
+        elif nin == 0 and regs.count(d) == 1:
+            others = list(terms)
+            others.remove(names[d])
+            terms = [names[d], str(j*k + pcs*j*(j - 1)//2)]
+            if others:
+                terms.append('{}*({})'.format(j, ' + '.join(others)))
+            body.append('{} = {}'.format(names[d], ' + '.join(terms)))
+        else:
+            body.append('for q in range({}): {} = {}'.format(
+                j, names[d], looped))
+        if d < 5:
+            written.add(d)
+        ip += j
+    else:
+        body.append('ip = {}'.format(ip))
+    body += ['r[{}] = {}'.format(x, names[x]) for x in sorted(written)]
+    src = 'def block(r):\n    A, B, C, D, E = r\n{}\n    return ip\n'.format(
+        ''.join('    {}\n'.format(line) for line in body))
+    env = {'read': read, 'write': write}
+    exec(compile(src, '<vd3 block>', 'exec'), env)
+    return env['block']
+
+def landing(prog, ip):
+    # the target if the line at ip is a PC write of a constant, else None
+    runs, starts, n, repeat = prog
+    if 0 <= ip < n:
+        i = bisect.bisect(starts, ip) - 1
+        op = decode(runs[i][0], runs[i][1], ip)
+    elif ip >= n and repeat:
+        op = decode(runs[-1][0], runs[-1][1])
+    else:
+        return None
+    return op[5] if op[0] == JMP0 else None
+
+def sled(prog, ip, target):
+    # the widest range of lines around ip that all jump straight to target,
+    # with None as the upper end if it extends through the repeated tail
+    runs, starts, n, repeat = prog
+    def pure(i):
+        op = decode(runs[i][0], runs[i][1])
+        return op[0] == JMP0 and op[5] == target
+    i = bisect.bisect(starts, min(ip, n - 1)) - 1
+    if ip < n and not pure(i):
+        return ip, ip
+    lo, hi = i, i
+    while lo > 0 and pure(lo - 1):
+        lo -= 1
+    while hi < len(runs) - 1 and pure(hi + 1):
+        hi += 1
+    if hi == len(runs) - 1 and repeat:
+        return starts[lo], None
+    return starts[lo], starts[hi] + runs[hi][2] - 1
+
+def cycle(prog, r, head):
+    # symbolically runs one iteration of the loop at head on a copy of the
+    # registers, with each value an affine combination of the registers at
+    # head; gives up on IN, OUT, or anything other than registers that are
+    # invariant, set from invariants, or incremented by invariants
+    runs, starts, n, repeat = prog
+    sym = [[int(x == y) for y in range(5)] + [0] for x in range(5)]
+    val = list(r)
+    guards = []
+    ip = head
+    for _ in range(4096):
+        if 0 <= ip < n:
+            i = bisect.bisect(starts, ip) - 1
+            cmd, line, count = runs[i]
+            op = decode(cmd, line, ip)
+            j = starts[i] + count - ip
+        elif ip >= n and repeat:
+            cmd, line, count = runs[-1]
+            op = decode(cmd, line, ip)
+            j = 1
+        else:
+            return None
+        d, regs, _, nin, k, line = operands(op)
+        pcs = cmd[1:].count('PC')
+        if nin > 0 or d == OUT or ip >= n and pcs > 0:
+            return None
+        e = [sum(sym[x][y] for x in regs) for y in range(6)]
+        e[5] += k
+        if d == PC:
+            target = sum(val[x] for x in regs) + k
+            if regs:
+                jump = landing(prog, target)
+                guards.append((e, jump, target))
+                if jump is not None:
+                    target = jump
+            ip = target
+            if ip == head:
+                break
+            continue
+        if d not in regs:
+            e[5] += pcs*(j - 1)
+            v = sum(val[x] for x in regs) + k + pcs*(j - 1)
+        elif regs.count(d) == 1:
+            e = [sym[d][y] + j*(e[y] - sym[d][y]) for y in range(6)]
+            e[5] += pcs*j*(j - 1)//2
+            v = val[d] + j*(sum(val[x] for x in regs) - val[d] + k) + \
+                pcs*j*(j - 1)//2
+        else:
+            return None
+        sym[d] = e
+        val[d] = v
+        ip += j
+        if ip == head:
+            break
+    else:
+        return None
+    acc = []
+    sets = []
+    inv = [sym[x] == [int(x == y) for y in range(5)] + [0] for x in range(5)]
+    for x in range(5):
+        if inv[x]:
+            continue
+        if any(sym[x][y] and not inv[y] and y != x for y in range(5)) or \
+                sym[x][x] not in (0, 1):
+            return None
+        if sym[x][x]:
+            acc.append((x, sym[x][:x] + [0] + sym[x][x+1:]))
+        else:
+            sets.append((x, sym[x]))
+    if not guards:
+        return None
+    return acc, sets, guards
+
+def accelerate(prog, loop, r):
+    # skips as many whole iterations of a summarized loop as every dynamic
+    # PC write in it is known to keep landing in the same place
+    acc, sets, guards = loop
+    value = lambda e: sum(c*v for c, v in zip(e, r)) + e[5]
+    if any(r[x] != value(e) for x, e in sets):
+        return 0
+    delta = [0]*5
+    for x, e in acc:
+        delta[x] = value(e)
+    iters = None
+    for e, jump, target in guards:
+        t = value(e)
+        dt = sum(c*v for c, v in zip(e, delta))
+        if jump is None:
+            lo, hi = target, target
+        elif landing(prog, t) == jump:
+            lo, hi = sled(prog, t, jump)
+        else:
+            return 0
+        if t < lo or hi is not None and t > hi:
+            return 0
+        if dt > 0 and hi is not None:
+            count = (hi - t)//dt + 1
+        elif dt < 0:
+            count = (t - lo)//-dt + 1
+        else:
+            continue
+        iters = count if iters is None else min(iters, count)
+    if iters is None or iters < 2:
+        return 0
+    for x in range(5):
+        r[x] += iters*delta[x]
+    return iters
+
+def execute(prog, r, ip, read, write):
+    runs, starts, n, repeat = prog
+    if repeat:
+        tail = decode(runs[-1][0], runs[-1][1])
+    blocks = {}
+    loops = {}
     while True:
-        if ip >= len(cmds) and repeat:
-            cmd = cmds[-1]
-        elif ip < 0 or ip >= len(cmds):
-            return
+        if 0 <= ip < n:
+            # single lines run one at a time until entered 8 times, so code
+            # that only runs once never pays for compiling a superblock;
+            # repeated commands are folded right away
+            block = blocks.get(ip, 0)
+            if isinstance(block, int):
+                i = bisect.bisect(starts, ip) - 1
+                cmd, line, count = runs[i]
+                if block < 8 and starts[i] + count - ip == 1:
+                    blocks[ip] = block + 1
+                    ip = step(decode(cmd, line, ip), r, ip, read, write)
+                    continue
+                block = blocks[ip] = superblock(prog, ip, read, write)
+            # lines entered often are summarized once as a loop if possible,
+            # after which whole runs of iterations are skipped on arrival
+            loop = loops.get(ip, 0)
+            if isinstance(loop, int):
+                loops[ip] = loop + 1 if loop < 16 else cycle(prog, r, ip)
+            elif loop is not None:
+                accelerate(prog, loop, r)
+            ip = block(r)
+        elif ip >= n and repeat:
+            d, regs, pcs, nin, k, line = operands(tail)
+            if d == PC and pcs == 1 and nin == 0 and \
+                    k + sum(r[x] for x in regs) < 0:
+                # a backward relative jump past the end keeps repeating
+                # until it lands back inside the program
+                delta = k + sum(r[x] for x in regs)
+                ip += ((ip - n)//-delta + 1)*delta
+            else:
+                ip = step(tail, r, ip, read, write)
         else:
-            cmd = cmds[ip]
-        total = sum(value(arg) for arg in cmd[1:])
-        if cmd[0] in 'ABCDE':
-            vardict[cmd[0]] = total
-        elif cmd[0] == 'PC':
-            ip = total - 1
-        elif cmd[0] == 'OUT':
+            return
+
+def run(code, v1=False):
+    execute(parse(code, v1), [0]*5, 0, read, write)
+
+def run_batch(code, inputs, v1=False):
+    # runs one program over many inputs in lockstep, returning the output of
+    # each, or the exception that stopped it; registers are int64 arrays
+    # with one lane per input, lanes are grouped by line each step, and a
+    # lane whose values would leave the int64 range finishes on the scalar
+    # interpreter
+    import numpy as np
+    prog = parse(code, v1)
+    runs, starts, n, repeat = prog
+    limit = 2**60
+    lanes = len(inputs)
+    width = max((len(data) for data in inputs), default=0)
+    inbuf = np.full((lanes, width + 1), -1, dtype=np.int64)
+    for lane, data in enumerate(inputs):
+        inbuf[lane, :len(data)] = np.frombuffer(bytes(data), dtype=np.uint8)
+    r = np.zeros((5, lanes), dtype=np.int64)
+    ip = np.zeros(lanes, dtype=np.int64)
+    pos = np.zeros(lanes, dtype=np.int64)
+    outlanes = []
+    outvals = []
+    extra = {}
+    errors = {}
+    def finish(lane):
+        out = extra[lane] = bytearray()
+        inpos = [int(pos[lane])]
+        def lane_read():
+            inpos[0] += 1
+            return int(inbuf[lane, min(inpos[0] - 1, width)])
+        def lane_write(total, line, count=1):
             if total < 0 or total > 255:
-                raise ValueError('line {}: invalid character'.format(i + 1))
-            sys.stdout.buffer.write(bytes([total]))
-            sys.stdout.flush()
-        ip += 1
+                raise ValueError('line {}: invalid character'.format(line))
+            out.extend(bytes([total])*count)
+        regs = [int(x) for x in r[:, lane]]
+        try:
+            execute(prog, regs, int(ip[lane]), lane_read, lane_write)
+        except Exception as e:
+            errors[lane] = e
+    ops = {}
+    if repeat:
+        cmd, line, count = runs[-1]
+        ops[n] = decode(cmd, line), 1, cmd[1:].count('PC')
+    live = np.arange(lanes)
+    while True:
+        at = ip[live]
+        live = live[(at >= 0) & ((at < n) | repeat)]
+        if live.size == 0:
+            break
+        at = np.minimum(ip[live], n)
+        order = np.argsort(at, kind='stable')
+        live, at = live[order], at[order]
+        keys, bounds = np.unique(at, return_index=True)
+        bounds = list(bounds) + [live.size]
+        slow = []
+        for idx, p in enumerate(keys.tolist()):
+            g = live[bounds[idx]:bounds[idx + 1]]
+            if p not in ops:
+                i = bisect.bisect(starts, p) - 1
+                cmd, line, count = runs[i]
+                ops[p] = decode(cmd, line, p), starts[i] + count - p, \
+                    cmd[1:].count('PC')
+            op, j, pcs = ops[p]
+            d, regs, _, nin, k, line = operands(op)
+            if abs(k) >= limit or abs(j*k + pcs*j*(j - 1)//2) >= limit:
+                slow.extend(g.tolist())
+                continue
+            total = np.full(g.size, k, dtype=np.int64)
+            if p == n:
+                total += pcs*ip[g]
+            for x in regs:
+                total += r[x, g]
+            for t in range(nin):
+                total += inbuf[g, np.minimum(pos[g] + t, width)]
+            if d == PC and p == n and pcs == 1 and nin == 0:
+                # same landing rule as the scalar tail for backward jumps
+                delta = total - ip[g]
+                back = delta < 0
+                steps = (ip[g][back] - n)//-delta[back] + 1
+                total[back] = ip[g][back] + steps*delta[back]
+            elif j > 1 and d < 5 and nin == 0 and d not in regs:
+                total += pcs*(j - 1)
+            elif j > 1 and d < 5 and nin == 0 and regs.count(d) == 1:
+                others = total - r[d, g] - k
+                ok = np.abs(others) < limit//j
+                slow.extend(g[~ok].tolist())
+                g, others = g[ok], others[ok]
+                total = r[d, g] + j*others + (j*k + pcs*j*(j - 1)//2)
+            elif not (j > 1 and d == OUT and pcs == 0 and nin == 0):
+                j = 1
+            ok = np.abs(total) < limit
+            slow.extend(g[~ok].tolist())
+            g, total = g[ok], total[ok]
+            pos[g] += nin
+            if d < 5:
+                r[d, g] = total
+                ip[g] += j
+            elif d == PC:
+                ip[g] = total
+            else:
+                bad = (total < 0) | (total > 255)
+                for lane in g[bad].tolist():
+                    errors[lane] = ValueError(
+                        'line {}: invalid character'.format(line))
+                ip[g[bad]] = -1
+                g, total = g[~bad], total[~bad]
+                outlanes.append(np.repeat(g, j))
+                outvals.append(np.repeat(total, j))
+                ip[g] += j
+        if slow:
+            for lane in slow:
+                finish(lane)
+            live = np.setdiff1d(live, slow)
+    results = [b''] * lanes
+    if outlanes:
+        outlanes = np.concatenate(outlanes)
+        order = np.argsort(outlanes, kind='stable')
+        outvals = np.concatenate(outvals)[order].astype(np.uint8)
+        bounds = np.searchsorted(outlanes[order], np.arange(lanes + 1))
+        results = [outvals[bounds[lane]:bounds[lane + 1]].tobytes()
+                   for lane in range(lanes)]
+    return [errors[lane] if lane in errors else
+            out + bytes(extra.get(lane, b''))
+            for lane, out in enumerate(results)]
 
 if __name__ == '__main__':
     if len(sys.argv) < 2 or sys.argv[1] == '-n' and len(sys.argv) < 3: